@@ -1,12 +1,17 @@
 import os
+import multiprocessing
 import urllib.parse
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from flask_caching import Cache
+from flask_migrate import Migrate
 from dotenv import load_dotenv
 import google.generativeai as genai
 
 load_dotenv()
 db = SQLAlchemy()
+cache = Cache()
+migrate = Migrate()
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
 def create_app():
@@ -32,6 +37,16 @@ def create_app():
         app.config["SQLALCHEMY_DATABASE_URI"] = (
             f"mysql+pymysql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
         )
+        # Room for the request threads plus the background paper builds; pre-ping and
+        # recycle drop connections the server closed while idle, and LIFO keeps reusing
+        # the warm ones so the rest can time out during quiet periods
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            "pool_size": int(os.getenv("DB_POOL_SIZE", "20")),
+            "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "40")),
+            "pool_pre_ping": True,
+            "pool_recycle": 1800,
+            "pool_use_lifo": True,
+        }
     else:
         # Fallback to SQLite (only for local development/testing)
         app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///dev.db"
@@ -41,17 +56,47 @@ def create_app():
     # These lines must be at the same indentation level as the 'if/else' block
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     app.config["JSON_SORT_KEYS"] = False
+    # Internal nginx location for /static/papers, e.g. "/protected/papers" (unset: Flask serves PDFs)
+    app.config["PDF_X_ACCEL_PREFIX"] = os.getenv("PDF_X_ACCEL_PREFIX")
+    # Generated PDFs/.docx files; created here once instead of on every paper build
+    app.config["PAPERS_DIR"] = os.path.join(app.root_path, "static", "papers")
+    os.makedirs(app.config["PAPERS_DIR"], exist_ok=True)
+    # The DB holds every paper; set DEBUG_WRITE_JSON=1 to also dump <paper_id>.json next to it
+    app.config["DEBUG_WRITE_JSON"] = os.getenv("DEBUG_WRITE_JSON", "").lower() in ("1", "true", "yes")
 
     db.init_app(app)
 
+    # Gemini responses are cached so repeat requests skip the LLM round-trip: on disk by
+    # default, or in Redis (shared by every worker/instance) when CACHE_REDIS_URL is set.
+    # Past CACHE_THRESHOLD entries the disk backend prunes expired and then the oldest entries.
+    # LLM_CACHE=0 turns the lookup off, e.g. while tuning the prompt.
+    app.config["LLM_CACHE"] = os.getenv("LLM_CACHE", "1").lower() not in ("0", "false", "no")
+    redis_url = os.getenv("CACHE_REDIS_URL")
+    cache.init_app(app, config={
+        "CACHE_TYPE": "RedisCache" if redis_url else "FileSystemCache",
+        "CACHE_REDIS_URL": redis_url,
+        "CACHE_DIR": os.getenv("CACHE_DIR", os.path.join(app.instance_path, "cache", "gemini")),
+        "CACHE_THRESHOLD": int(os.getenv("CACHE_THRESHOLD", "2000")),
+        "CACHE_DEFAULT_TIMEOUT": 24 * 60 * 60,
+    })
+    migrate.init_app(app, db)
+
     with app.app_context():
         # Code inside the context block (indented one more level)
         from . import models  # noqa: F401
         
-        # This is where the connection attempt happens
+        # This is where the connection attempt happens.
+        # create_all() only adds missing tables; columns and indexes added to existing
+        # tables come from `flask db upgrade` (see migrations/)
         db.create_all()
         
-        from .routes import main as main_bp
+        from .routes import main as main_bp, warm_pdf_workers
         app.register_blueprint(main_bp)
+        # Start the PDF render processes before the first paper needs one. Never from a
+        # spawned child re-importing the entry script: it can't start processes while still
+        # bootstrapping, and the failed start breaks the whole pool. (parent_process() is
+        # still None at that point; the child's name is already set.)
+        if multiprocessing.current_process().name == "MainProcess":
+            warm_pdf_workers()
 
     return app
@@ -1,5 +1,8 @@
 from . import db
 
+# Shared stand-in for "no options" so as_dict() doesn't allocate a list per row
+_EMPTY = ()
+
 # app/models.py
 
 # New model for the 'Boards' table
@@ -7,51 +10,68 @@ class Board(db.Model):
     __tablename__ = "boards"
     board_id = db.Column(db.Integer, primary_key=True) # CHANGED from id
     name = db.Column(db.String(50), nullable=False, unique=True)
-    classes = db.relationship("Class", backref="board", lazy=True, cascade="all, delete-orphan")
+    classes = db.relationship("Class", back_populates="board", lazy=True, cascade="all, delete-orphan")
 
 # New model for the 'Classes' table
 class Class(db.Model):
     __tablename__ = "classes"
     class_id = db.Column(db.Integer, primary_key=True) # CHANGED from id
-    board_id = db.Column(db.Integer, db.ForeignKey("boards.board_id"), nullable=False) # CHANGED foreign key target
+    board_id = db.Column(db.Integer, db.ForeignKey("boards.board_id"), nullable=False, index=True) # CHANGED foreign key target
     class_number = db.Column(db.Integer, nullable=False)
-    subjects = db.relationship("Subject", backref="class_", lazy=True, cascade="all, delete-orphan")
+    board = db.relationship("Board", back_populates="classes", lazy=True)
+    subjects = db.relationship("Subject", back_populates="class_", lazy=True, cascade="all, delete-orphan")
 
 # New model for the 'Subjects' table
 class Subject(db.Model):
     __tablename__ = "subjects"
     subject_id = db.Column(db.Integer, primary_key=True) # CHANGED from id
-    class_id = db.Column(db.Integer, db.ForeignKey("classes.class_id"), nullable=False) # CHANGED foreign key target
+    class_id = db.Column(db.Integer, db.ForeignKey("classes.class_id"), nullable=False, index=True) # CHANGED foreign key target
     name_en = db.Column(db.String(100), nullable=False)
     name_hi = db.Column(db.String(100), nullable=False)
-    chapters = db.relationship("Chapter", backref="subject", lazy=True, cascade="all, delete-orphan")
+    class_ = db.relationship("Class", back_populates="subjects", lazy=True)
+    chapters = db.relationship("Chapter", back_populates="subject", lazy=True, cascade="all, delete-orphan")
 
 # New model for the 'Chapters' table
 class Chapter(db.Model):
     __tablename__ = "chapters"
     chapter_id = db.Column(db.Integer, primary_key=True) # CHANGED from id
-    subject_id = db.Column(db.Integer, db.ForeignKey("subjects.subject_id"), nullable=False) # CHANGED foreign key target
+    subject_id = db.Column(db.Integer, db.ForeignKey("subjects.subject_id"), nullable=False, index=True) # CHANGED foreign key target
     chapter_number = db.Column(db.Integer)
     title_en = db.Column(db.String(255), nullable=False)
     title_hi = db.Column(db.String(255), nullable=False)
-    questions = db.relationship("Question", backref="chapter", lazy=True)
+    subject = db.relationship("Subject", back_populates="chapters", lazy=True)
+    questions = db.relationship("Question", back_populates="chapter", lazy=True)
 
 # MODIFIED Question model
 class Question(db.Model):
     __tablename__ = "questions"
+    __table_args__ = (
+        # Question bank lookups filter by chapter, then type and difficulty
+        db.Index("ix_q_chap_type_diff", "chapter_id", "question_type", "difficulty"),
+        # The paper fallback filters by type, marks and language, then chapter; with the
+        # id implicitly in the index its id sample never has to touch the table rows
+        db.Index("ix_q_lookup", "question_type", "marks", "language", "chapter_id"),
+        # Spotting AI questions the chapter already has before inserting them again
+        db.Index("ix_q_chap_fingerprint", "chapter_id", "fingerprint"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     chapter_id = db.Column(db.Integer, db.ForeignKey("chapters.chapter_id"), nullable=False) # CHANGED foreign key target
+    # Lazy here so id-only and count queries stay single-table; queries that call as_dict()
+    # load the chapter -> subject -> class_ -> board chain up front (routes._QUESTION_AS_DICT_OPTIONS)
+    chapter = db.relationship("Chapter", back_populates="questions", lazy=True)
 
     # ... keep the rest of the Question model fields the same ...
     question_type = db.Column(db.String(50))
     difficulty = db.Column(db.String(20))
     marks = db.Column(db.Integer)
     question_text = db.Column(db.Text)
-    options = db.Column(db.JSON, default=[])
+    options = db.Column(db.JSON, default=list)
     answer = db.Column(db.Text)
     source = db.Column(db.String(50))
     explanation = db.Column(db.Text)
     language = db.Column(db.String(20), default='english', nullable=False)
+    # blake2b of the case/space-folded question text (see routes._question_fingerprint)
+    fingerprint = db.Column(db.String(16))
 
     def as_dict(self):
         return {
@@ -65,7 +85,7 @@ class Question(db.Model):
             "difficulty": self.difficulty,
             "marks": self.marks,
             "question_text": self.question_text,
-            "options": self.options or [],
+            "options": self.options if self.options else _EMPTY,
             "answer": self.answer,
             "source": self.source,
             "explanation": self.explanation,
@@ -101,10 +121,34 @@ class Paper(db.Model):
     total_questions = db.Column(db.Integer)
     total_marks = db.Column(db.Integer)
     pdf_path = db.Column(db.String(255))
+    # "pending" until the background build has chosen the questions, then "done" (or "failed")
+    status = db.Column(db.String(20), nullable=False, default="done", server_default="done")
+    # False while the PDF is still being rendered in the background
+    pdf_ready = db.Column(db.Boolean, nullable=False, default=True, server_default=db.text("1"))
+    # Rendering failed after the questions were delivered: the paper stays "done" (its Word and
+    # answer-key downloads rebuild on demand) and clients stop waiting for the PDF
+    pdf_failed = db.Column(db.Boolean, nullable=False, default=False, server_default=db.text("0"))
     word_path = db.Column(db.String(255))
     answer_key_path = db.Column(db.String(255))
     visitor_id = db.Column(db.String(50), db.ForeignKey('visitors.visitor_id'), nullable=True)
-    questions = db.relationship("PaperQuestion", back_populates="paper", cascade="all, delete-orphan")
+    questions = db.relationship("PaperQuestion", back_populates="paper", cascade="all, delete-orphan",
+                                order_by="PaperQuestion.id")
+
+    def as_dict(self):
+        # Same shape as the JSON sidecar written next to the PDF
+        return {
+            "paper_id": self.paper_id,
+            "examName": self.exam_name,
+            "schoolName": self.school_name,
+            "schoolBoard": self.board,
+            "class": self.class_,
+            "subject": self.subject,
+            "questions": [pq.as_dict() for pq in self.questions],
+            "summary": {
+                "total_questions": self.total_questions,
+                "total_marks": self.total_marks
+            }
+        }
 
 
 class PaperQuestion(db.Model):
@@ -117,6 +161,21 @@ class PaperQuestion(db.Model):
     type = db.Column(db.String(50))
     difficulty = db.Column(db.String(20))
     marks = db.Column(db.Integer)
-    options = db.Column(db.JSON, default=[])
+    options = db.Column(db.JSON, default=list)
     answer = db.Column(db.Text)
+    explanation = db.Column(db.Text)
+    source = db.Column(db.String(50))
     paper = db.relationship("Paper", back_populates="questions")
+
+    def as_dict(self):
+        return {
+            "id": self.question_id,
+            "question_text": self.question_text,
+            "question_type": self.type,
+            "difficulty": self.difficulty,
+            "marks": self.marks,
+            "options": self.options if self.options else _EMPTY,
+            "answer": self.answer,
+            "explanation": self.explanation,
+            "source": self.source
+        }
@@ -0,0 +1,46 @@
+# WeasyPrint side of PDF rendering: the only code the PDF worker processes run.
+# Workers are started with "spawn", so each one imports this module fresh. Keep it free of
+# routes, models and create_app(): importing the app package only defines db/cache, it
+# doesn't build an app, connect to the database or read the request config.
+import hashlib
+import os
+import uuid
+
+from weasyprint import CSS, HTML
+from weasyprint.text.fonts import FontConfiguration
+
+PAPER_CSS_PATH = os.path.join(os.path.dirname(__file__), "static", "css", "paper_pdf.css")
+# Part of every PDF's content hash, so editing the stylesheet re-renders cached papers
+with open(PAPER_CSS_PATH, "rb") as _css_file:
+    PAPER_CSS_DIGEST = hashlib.sha256(_css_file.read()).digest()
+_pdf_style = None
+
+
+def _pdf_stylesheet():
+    """The paper stylesheet and its font configuration, parsed once per process"""
+    global _pdf_style
+    if _pdf_style is None:
+        font_config = FontConfiguration()
+        _pdf_style = (CSS(filename=PAPER_CSS_PATH, font_config=font_config), font_config)
+    return _pdf_style
+
+
+def init_worker():
+    # Warm the stylesheet and fonts when the worker starts, not during its first paper
+    _pdf_stylesheet()
+
+
+def worker_ready():
+    return None
+
+
+def build_pdf(path, rendered_html):
+    # Content-addressed names can be shared by concurrent builds, and the answer key is linked
+    # before it exists, so never expose a half-written file
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    stylesheet, font_config = _pdf_stylesheet()
+    # No presentational hints: the template carries no HTML styling attributes, so skip mapping them
+    HTML(string=rendered_html).write_pdf(
+        tmp_path, stylesheets=[stylesheet], font_config=font_config, presentational_hints=False
+    )
+    os.replace(tmp_path, path)
@@ -1,39 +1,177 @@
+import io
 import os
-import json
 import re
 import uuid
-import io
-from datetime import datetime
-from flask import Blueprint, request, jsonify, render_template, current_app, send_file, render_template_string, make_response
-from sqlalchemy.sql.expression import func
-from sqlalchemy.orm import joinedload
+import threading
+import zipfile
+import hashlib
+import random
+from collections import Counter
+import orjson
+import msgspec
+from typing import Any, List
+from datetime import datetime, timedelta
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from xml.sax.saxutils import escape
+from flask import Blueprint, request, jsonify, render_template, current_app, send_file, make_response
+from sqlalchemy import func, insert, select, tuple_, update
+from sqlalchemy.orm import joinedload, raiseload, selectinload
 from docx import Document
-from weasyprint import HTML
-import pathlib
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import Paragraph
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfgen import canvas
 
 import google.generativeai as genai
 from .models import Question, Paper, PaperQuestion, Visitor, Board, Class, Subject, Chapter
-from . import db
+from . import db, cache, pdf_render
 
 main = Blueprint("main", __name__)
 
+# Paper builds (Gemini call, DB writes, PDF/DOCX rendering) run here instead of in the
+# request thread. Progress lives on the Paper row (status, pdf_ready), so any worker
+# process can answer a poll.
+_paper_executor = ThreadPoolExecutor(max_workers=int(os.getenv("PAPER_BUILD_WORKERS", "4")))
+# Jobs in that pool die with the process (restart, worker recycle). A row still pending
+# after this long has no build behind it any more and is reported as failed.
+_PAPER_BUILD_TIMEOUT = timedelta(minutes=int(os.getenv("PAPER_BUILD_TIMEOUT_MINUTES", "10")))
+
+# Everything in the Gemini prompt that never changes. It must stay the leading part of
+# the prompt (and byte-for-byte stable) for the provider's prefix caching to apply.
+SYSTEM_PROMPT_PREFIX = """You are an experienced school teacher creating a question paper.
+The board, class, subject, language and question counts for this paper are given in the
+PAPER REQUEST section at the end.
+
+CRITICAL INSTRUCTIONS:
+1. Generate EXACTLY the number and types of questions specified in the PAPER REQUEST
+2. ALL questions MUST be appropriate for the board, class and subject (or topic) requested
+3. Follow the difficulty distribution as closely as possible
+4. ALL content MUST be in the requested language
+
+QUESTION TYPE GUIDELINES:
+- MCQ: one clearly correct option and three plausible distractors; no "all of the above"
+- Fill in the Blanks: a single statement with the missing word or phrase shown as "______"
+- Short Answer: answerable in two to four sentences
+- Long Answer: needs an explained, multi-part or step-by-step response
+- Matching: put both columns in the question text as "Column A: ... Column B: ..."
+- Case Study: a short passage or scenario followed by the question about it
+- "Easy" checks recall, "Medium" checks understanding, "Hard" needs application or analysis
+
+OUTPUT FORMAT REQUIREMENTS:
+- Return ONLY a valid JSON array of question objects
+- Do NOT include any other text, explanations, or markdown formatting
+- Each question object MUST have these exact keys:
+  - "type" (e.g., "MCQ", "Short Answer", "Long Answer", etc.)
+  - "question" (the question text)
+  - "options" (ONLY for "MCQ" type: exactly 4 options as a JSON array of strings)
+  - "marks" (integer)
+  - "difficulty" ("Easy", "Medium", or "Hard")
+  - "answer" (correct answer - for MCQ provide the letter like "A" or "B")
+  - "explanation" (brief explanation)
+
+Example MCQ format:
+{
+  "type": "MCQ",
+  "question": "What is the capital of France?",
+  "options": ["London", "Berlin", "Paris", "Madrid"],
+  "marks": 1,
+  "difficulty": "Easy",
+  "answer": "C",
+  "explanation": "Paris is the capital of France."
+}
+"""
+
+# Tried in order until one answers
+_GEMINI_MODEL_NAMES = ("models/gemini-flash-latest", "models/gemini-pro-latest", "models/gemini-2.0-flash")
+_gemini_models = {}
+_gemini_models_lock = threading.Lock()
+
+# How long a cached Gemini response is reused for identical requests (seconds)
+AI_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Everything Question.as_dict() walks, loaded up front. raiseload("*") turns any other
+# relationship access on these rows into an error instead of a hidden per-row SELECT.
+_QUESTION_AS_DICT_OPTIONS = (
+    joinedload(Question.chapter)
+    .joinedload(Chapter.subject)
+    .joinedload(Subject.class_)
+    .joinedload(Class.board),
+    raiseload("*"),
+)
+
+
+# Shape of one question in the Gemini response, mirroring the schema in the prompt.
+# Fields are untyped on purpose: the model sends marks as 1.5 or "1 mark" and answers as
+# numbers or lists, and one odd field mustn't fail the decode of the whole list. Items are
+# coerced one by one in _decode_ai_questions instead. Unknown keys are ignored.
+class _AIQuestion(msgspec.Struct):
+    type: Any = None
+    question: Any = ""
+    options: Any = None  # normalised later: the model sometimes sends a JSON string
+    marks: Any = None
+    difficulty: Any = None
+    answer: Any = "Not provided"
+    explanation: Any = ""
+
+
+_AI_QUESTIONS_DECODER = msgspec.json.Decoder(List[_AIQuestion])
+_MARKS_RE = re.compile(r"\d+")
+
+
+def _ai_text(value, default=""):
+    """A free-text field from the model as a string"""
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return ", ".join(str(v) for v in value)
+    return str(value)
+
+
+def _ai_marks(value):
+    """Whole marks from 2, 1.5, "2" or "2 marks"; None when there's no number"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        match = _MARKS_RE.search(value)
+        return int(match.group(0)) if match else None
+    return None
+
+
+def _decode_ai_questions(text):
+    return [
+        {
+            "type": _ai_text(q.type) or None,
+            "question": _ai_text(q.question),
+            "options": q.options,
+            "marks": _ai_marks(q.marks),
+            "difficulty": _ai_text(q.difficulty) or None,
+            "answer": _ai_text(q.answer, "Not provided"),
+            "explanation": _ai_text(q.explanation),
+        }
+        for q in _AI_QUESTIONS_DECODER.decode(text)
+    ]
+
+
+# Patterns used on every request, compiled once at import
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+_LEADING_DOLLAR_RE = re.compile(r'^\s*\$')
+_TRAILING_DOLLAR_RE = re.compile(r'\$\s*$')
+_SUPERSCRIPT_RE = re.compile(r'(\d+)\^(\d+)')
+_FRAC_RE = re.compile(r'\\frac\{([^}]+)\}\{([^}]+)\}')
+
 
 # In app/routes.py (After imports, before get_or_create_visitor)
 
-# Helper function to clean and render simple math symbols for WeasyPrint/ReportLab
+# Helper function to clean and render simple math symbols for WeasyPrint
 def render_simple_math(text):
     if not text:
         return ""
     
     # 1. Remove surrounding $ signs (which the AI uses for LaTeX)
-    text = re.sub(r'^\s*\$', '', text)
-    text = re.sub(r'\$\s*$', '', text)
+    text = _LEADING_DOLLAR_RE.sub('', text)
+    text = _TRAILING_DOLLAR_RE.sub('', text)
     
     # 2. Replace common LaTeX commands with Unicode/HTML symbols
     text = text.replace(r'\times', '×')      # Multiplication symbol
@@ -45,20 +183,15 @@ def render_simple_math(text):
     
     # 3. Handle simple superscripts (e.g., 3^2 -> 3<sup>2</sup>)
     # This is a simplification; WeasyPrint supports <sup> tags.
-    text = re.sub(r'(\d+)\^(\d+)', r'\1<sup>\2</sup>', text)
+    text = _SUPERSCRIPT_RE.sub(r'\1<sup>\2</sup>', text)
     
     # 4. Handle simple fractions: replace \frac{1}{3} with (1/3) or <sup>1</sup>&frasl;<sub>3</sub>
     # Using simple HTML for better readability in PDF
-    text = re.sub(r'\\frac\{([^}]+)\}\{([^}]+)\}', r'<sup>\1</sup>&frasl;<sub>\2</sub>', text)
+    text = _FRAC_RE.sub(r'<sup>\1</sup>&frasl;<sub>\2</sub>', text)
     
     return text
 
 
-
-
-
-
-
 def get_or_create_visitor():
     """Get existing visitor from cookie or create new visitor"""
     visitor_id = request.cookies.get('visitor_id')
@@ -151,22 +284,233 @@ def index():
     
     return response
 
+# PDF sections, in the order they appear on the paper
+_SECTION_ORDER = ("Multiple Choice", "Fill in the Blanks", "Short Answer", "Long Answer", "Matching", "Case Study")
+_SECTION_TITLES = {
+    "Multiple Choice": "Section A - Multiple Choice Questions",
+    "Fill in the Blanks": "Section B - Fill in the Blanks",
+    "Short Answer": "Section C - Short Answer Questions",
+    "Long Answer": "Section D - Long Answer Questions",
+    "Matching": "Section E - Matching Questions",
+    "Case Study": "Section F - Case Study"
+}
+# Every question type label we accept -> the section it is printed under
+_SECTION_FOR_TYPE = {
+    "MCQ": "Multiple Choice", "Multiple Choice": "Multiple Choice",
+    "Fill in the Blanks": "Fill in the Blanks", "Fill": "Fill in the Blanks",
+    "Short Answer": "Short Answer", "Short": "Short Answer",
+    "Long Answer": "Long Answer", "Long": "Long Answer",
+    "Matching": "Matching", "Match": "Matching", "Match the Following": "Matching",
+    "Case Study": "Case Study", "Case": "Case Study",
+}
+
+# Question type label -> canonical type stored on questions
+_QTYPE_MAP = {
+    "MCQ": "MCQ", "Multiple Choice": "MCQ",
+    "Fill in the Blanks": "Fill in the Blanks", "Fill": "Fill in the Blanks",
+    "Short Answer": "Short Answer", "Short": "Short Answer",
+    "Long Answer": "Long Answer", "Long": "Long Answer",
+    "Matching": "Matching", "Match": "Matching", "Match the Following": "Matching",
+    "Case Study": "Case Study", "Case": "Case Study",
+}
+
 # Helper function to normalize question types
 def _normalize_qtype(label):
     label = (label or "").strip()
-    if label in ["MCQ", "Multiple Choice"]: return "MCQ"
-    if label in ["Fill in the Blanks", "Fill"]: return "Fill in the Blanks"
-    if label in ["Short Answer", "Short"]: return "Short Answer"
-    if label in ["Long Answer", "Long"]: return "Long Answer"
-    if label in ["Matching", "Match", "Match the Following"]: return "Matching"
-    if label in ["Case Study", "Case"]: return "Case Study"
-    return label
+    return _QTYPE_MAP.get(label, label)
+
+def _question_fingerprint(text):
+    """Short hash of a question's text, ignoring case and spacing, for spotting repeats"""
+    normalized = " ".join((text or "").lower().split())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).hexdigest()
+
+def _normalize_options(options):
+    """MCQ options as a list of strings, whatever shape the model returned them in"""
+    if isinstance(options, str):
+        try:
+            options = orjson.loads(options)
+        except orjson.JSONDecodeError:
+            return []
+    if not isinstance(options, list):
+        # Missing or unusable: no options rather than None, so every consumer can iterate
+        return []
+    return [str(opt) for opt in options]
+
+def _ai_cache_key(board, class_, subject, qdist, ddist, language, topic, chapters):
+    """Stable key for everything that shapes the Gemini prompt"""
+    # School and exam name are deliberately left out (and out of the prompt): they only
+    # appear on the rendered paper, so every school asking for the same paper shares a hit
+    # Requests that only differ cosmetically (type label spelling, "5" vs 5, topic case and
+    # spacing, chapter order) ask Gemini for the same paper, so they share one key too
+    payload = orjson.dumps({
+        "b": board, "c": str(class_), "s": subject,
+        "q": {
+            _normalize_qtype(label): [int(info.get("count") or 0), int(info.get("marks") or 0)]
+            for label, info in qdist.items() if int(info.get("count") or 0) > 0
+        },
+        "d": {str(level).strip().lower(): str(share) for level, share in (ddist or {}).items()},
+        "l": language, "t": " ".join((topic or "").lower().split()),
+        "ch": sorted(chapters or []),
+    }, option=orjson.OPT_SORT_KEYS)
+    return "gemini:" + hashlib.blake2b(payload, digest_size=20).hexdigest()
+
+
+def _get_gemini_model(name):
+    """GenerativeModel objects are reused so each request doesn't rebuild the client"""
+    model = _gemini_models.get(name)
+    if model is None:
+        with _gemini_models_lock:
+            model = _gemini_models.get(name)
+            if model is None:
+                model = _gemini_models[name] = genai.GenerativeModel(name)
+    return model
+
+
+def _generate_ai_text(prompt):
+    """Send the prompt to Gemini, falling back through the other models on error"""
+    last_error = None
+    for name in _GEMINI_MODEL_NAMES:
+        try:
+            current_app.logger.info(f"Sending prompt to '{name}'")
+            response = _get_gemini_model(name).generate_content(prompt)
+            current_app.logger.info(f"Response received from '{name}'")
+            return response.text.strip()
+        except Exception as model_error:
+            current_app.logger.error(f"AI model error with {name}: {model_error}")
+            last_error = model_error
+    raise last_error
+
+
+def _parse_ai_questions(raw_text):
+    """Pull the JSON array of questions out of a Gemini response"""
+    # Usually the response is just the array: parse it as is, without searching or slicing
+    stripped = raw_text.strip()
+    if stripped.startswith("[") and stripped.endswith("]"):
+        try:
+            return _decode_ai_questions(stripped)
+        except msgspec.DecodeError:
+            pass
+    # Otherwise it is wrapped in a ``` fence or prose; slicing from the first '['
+    # to the last ']' covers both without a regex
+    start = raw_text.find("[")
+    end = raw_text.rfind("]")
+    if start >= 0 and end > start:
+        try:
+            return _decode_ai_questions(raw_text[start:end + 1])
+        except msgspec.DecodeError:
+            pass
+    json_match = _JSON_FENCE_RE.search(raw_text)
+    if json_match:
+        try:
+            return _decode_ai_questions(json_match.group(1))
+        except msgspec.DecodeError:
+            pass
+    raise ValueError("AI returned invalid JSON.")
+
 
 @main.route("/api/generate", methods=["POST"])
 def generate_paper():
-    data = request.get_json()
-    current_app.logger.info(f"Incoming /api/generate payload: {data}")
+    """Queue a paper build and return immediately; the client polls status_url"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data.get("questionDistribution"):
+        return jsonify({"error": "Invalid paper request."}), 400
+    # The full payload is only formatted when DEBUG logging is on
+    current_app.logger.debug("Incoming /api/generate payload: %s", data)
+    current_app.logger.info(
+        "Paper request: board=%s class=%s subject=%s types=%d",
+        data.get("schoolBoard"), data.get("class"), data.get("subject"), len(data["questionDistribution"]),
+    )
+
+    # Get or create visitor (needs the request cookies, so resolve it before queueing)
+    visitor = get_or_create_visitor()
+
+    paper_id = uuid.uuid4().hex[:8]
+    # The pending row is the job record: any worker process can answer a status poll
+    db.session.add(Paper(paper_id=paper_id, visitor_id=visitor.visitor_id, status="pending", pdf_ready=False))
+    db.session.commit()
+
+    app = current_app._get_current_object()
+    _paper_executor.submit(_run_build_paper, app, data, paper_id)
+
+    return jsonify({
+        "paper_id": paper_id,
+        "status": "pending",
+        "status_url": f"/api/paper/{paper_id}/status"
+    }), 202
+
+
+@main.route("/api/paper/<paper_id>/status", methods=["GET"])
+def paper_status(paper_id):
+    # build_paper() marks the Paper row done once the questions are chosen; the PDF follows
+    paper_entry = db.session.execute(
+        select(Paper).where(Paper.paper_id == paper_id).options(selectinload(Paper.questions))
+    ).scalar_one_or_none()
+    if paper_entry is None:
+        return jsonify({"error": "Paper not found"}), 404
+    still_building = paper_entry.status == "pending" or (
+        paper_entry.status == "done" and not paper_entry.pdf_ready and not paper_entry.pdf_failed
+    )
+    if still_building and _build_timed_out(paper_entry):
+        # Lost build: record it for good, unless the build got further in the meantime
+        _record_build_failure(paper_id)
+        current_app.logger.warning(f"Paper {paper_id} was still building after {_PAPER_BUILD_TIMEOUT}")
+        # The commit expired paper_entry: it's re-read below, so a late finish still shows
+    if paper_entry.status == "pending":
+        return jsonify({"paper_id": paper_id, "status": "pending"})
+    if paper_entry.status == "failed":
+        return jsonify({"paper_id": paper_id, "status": "failed", "error": "Paper generation failed."})
+
+    paper = paper_entry.as_dict()
+    return jsonify({
+        "paper_id": paper_id,
+        "status": "done",
+        "questions": [{
+            "id": q.get("id"), "question_text": q.get("question_text"),
+            "marks": q.get("marks"), "difficulty": q.get("difficulty"),
+            "type": q.get("type") or q.get("question_type"), "source": q.get("source", "Database")
+        } for q in paper.get("questions", [])],
+        "summary": paper.get("summary", {}),
+        "pdf_ready": bool(paper_entry.pdf_ready),
+        "pdf_failed": bool(paper_entry.pdf_failed),
+        "pdf_url": f"/api/download/pdf/{paper_id}",
+        "word_url": f"/api/download/word/{paper_id}",
+        "answer_key_url": f"/api/download/answer_key/{paper_id}"
+    })
+
+
+def _build_timed_out(paper_entry):
+    # created_at is set by the DB, so compare against the DB's clock, not ours
+    now = db.session.scalar(select(func.now()))
+    return paper_entry.created_at is not None and now - paper_entry.created_at >= _PAPER_BUILD_TIMEOUT
+
+
+def _record_build_failure(paper_id):
+    """Fail a paper still choosing its questions; one already delivered only loses its files"""
+    db.session.execute(
+        update(Paper).where(Paper.paper_id == paper_id, Paper.status == "pending").values(status="failed")
+    )
+    # Its questions are on screen with Word/answer-key links (built on demand), so keep it
+    # "done" and only stop waiting for the PDF
+    db.session.execute(
+        update(Paper)
+        .where(Paper.paper_id == paper_id, Paper.status == "done", Paper.pdf_ready.is_(False))
+        .values(pdf_failed=True)
+    )
+    db.session.commit()
+
+
+def _run_build_paper(app, data, paper_id):
+    with app.app_context():
+        try:
+            build_paper(data, paper_id)
+        except Exception:
+            app.logger.exception(f"Building paper {paper_id} failed")
+            db.session.rollback()
+            _record_build_failure(paper_id)
 
+
+def build_paper(data, paper_id):
+    """Generate the questions and all artifacts for one paper (runs off the request thread)"""
     subject = data.get("subject")
     class_ = data.get("class")
     board = data.get("schoolBoard")
@@ -179,28 +523,11 @@ def generate_paper():
     chapters = data.get("chapters", [])  # Get chapters if provided
     questions = []
 
-    # Get or create visitor
-    visitor = get_or_create_visitor()
-    
     # More robust topic detection
     topic_present = bool(topic and topic.strip())
     current_app.logger.info(f"Topic received: '{topic}'")
-    current_app.logger.info(f"Topic stripped: '{topic.strip()}'")
-    current_app.logger.info(f"Topic bool check: {topic_present}")
     current_app.logger.info(f"Using topic-based generation: {topic_present}")
-    
-    # Log all the data to debug
-    current_app.logger.info(f"All data received: {data}")
-    
-    # Test if API key is working
-    try:
-        current_app.logger.info("Testing Google Generative AI API key")
-        model = genai.GenerativeModel('models/gemini-flash-latest')
-        test_response = model.generate_content("Say 'Hello, World!' in one word.")
-        current_app.logger.info(f"API key test response: {test_response.text.strip()}")
-    except Exception as e:
-        current_app.logger.error(f"API key test failed: {e}")
-    
+
     qdist_str_parts = []
     for qtype, info in qdist.items():
         count = info.get('count', 0)
@@ -215,161 +542,63 @@ def generate_paper():
         language_instruction = "You MUST generate the entire question paper, including questions, options, answers, and explanations, strictly in English."
 
     try:
-        # Create different prompts based on generation mode
-        # More robust topic detection
-        topic_present = bool(topic and topic.strip())
-        current_app.logger.info(f"Using topic-based generation: {topic_present}")
-        
+        # The static instructions go first (SYSTEM_PROMPT_PREFIX) and only the
+        # request-specific part differs, so Gemini can reuse its cached prefix
         if topic_present:
             # Topic-based generation - improved prompt
             current_app.logger.info("Generating topic-based prompt")
-            prompt = f"""
-You are an experienced {board} school teacher creating a question paper. 
-Your task is to create a comprehensive question paper focused EXCLUSIVELY on the topic: "{topic}".
-
-School: {school}
-Class: {class_}
-Subject: {subject}
-
-{language_instruction}
-
-CRITICAL INSTRUCTIONS:
-1. Generate EXACTLY the number and types of questions specified below
-2. ALL questions MUST be directly related to the topic "{topic}"
-3. Do NOT include any questions unrelated to this topic
-4. Follow the difficulty distribution as closely as possible
-5. ALL content MUST be in {paper_language.capitalize()} language
-
-Question Distribution Requirements:
-{qdist_prompt_str}
-
-Difficulty Distribution Target:
-{ddist}
-
-OUTPUT FORMAT REQUIREMENTS:
-- Return ONLY a valid JSON array of question objects
-- Do NOT include any other text, explanations, or markdown formatting
-- Each question object MUST have these exact keys:
-  - "type" (e.g., "MCQ", "Short Answer", "Long Answer", etc.)
-  - "question" (the question text)
-  - "options" (ONLY for "MCQ" type: exactly 4 options as a JSON array of strings)
-  - "marks" (integer)
-  - "difficulty" ("Easy", "Medium", or "Hard")
-  - "answer" (correct answer - for MCQ provide the letter like "A" or "B")
-  - "explanation" (brief explanation)
-
-Example MCQ format:
-{{
-  "type": "MCQ",
-  "question": "What is the capital of France?",
-  "options": ["London", "Berlin", "Paris", "Madrid"],
-  "marks": 1,
-  "difficulty": "Easy",
-  "answer": "C",
-  "explanation": "Paris is the capital of France."
-}}
-
-Begin generating the question paper now:
-"""
+            scope = (
+                f'Topic: "{topic}"\n'
+                f'ALL questions MUST be directly related to the topic "{topic}". '
+                "Do NOT include any questions unrelated to this topic."
+            )
         else:
             # Class and chapters-based generation
             current_app.logger.info("Generating class/chapter-based prompt")
-            chapters_str = ""
+            scope = f"ALL questions MUST be appropriate for Class {class_} {subject}."
             if chapters:
-                chapters_str = f"Focus on these chapters: {', '.join(chapters)}."
-            
-            prompt = f"""
-You are an experienced {board} school teacher creating a question paper. 
-Your task is to create a comprehensive question paper for Class {class_}, Subject: {subject}.
+                scope += f"\nFocus on these chapters: {', '.join(chapters)}."
 
-School: {school}
-{chapters_str}
+        prompt = SYSTEM_PROMPT_PREFIX + f"""
+PAPER REQUEST
+Board: {board}
+Class: {class_}
+Subject: {subject}
+Language: {paper_language.capitalize()}
+{scope}
 
 {language_instruction}
 
-CRITICAL INSTRUCTIONS:
-1. Generate EXACTLY the number and types of questions specified below
-2. ALL questions MUST be appropriate for Class {class_} {subject}
-3. Follow the difficulty distribution as closely as possible
-4. ALL content MUST be in {paper_language.capitalize()} language
-
 Question Distribution Requirements:
 {qdist_prompt_str}
 
 Difficulty Distribution Target:
 {ddist}
 
-OUTPUT FORMAT REQUIREMENTS:
-- Return ONLY a valid JSON array of question objects
-- Do NOT include any other text, explanations, or markdown formatting
-- Each question object MUST have these exact keys:
-  - "type" (e.g., "MCQ", "Short Answer", "Long Answer", etc.)
-  - "question" (the question text)
-  - "options" (ONLY for "MCQ" type: exactly 4 options as a JSON array of strings)
-  - "marks" (integer)
-  - "difficulty" ("Easy", "Medium", or "Hard")
-  - "answer" (correct answer - for MCQ provide the letter like "A" or "B")
-  - "explanation" (brief explanation)
-
-Example MCQ format:
-{{
-  "type": "MCQ",
-  "question": "What is the capital of France?",
-  "options": ["London", "Berlin", "Paris", "Madrid"],
-  "marks": 1,
-  "difficulty": "Easy",
-  "answer": "C",
-  "explanation": "Paris is the capital of France."
-}}
-
 Begin generating the question paper now:
 """
-            
+
         # Log the prompt to see what's being sent to the AI
-        current_app.logger.info(f"Sending prompt to AI: {prompt}")
-        
-        # Use the already configured genai from __init__.py
-        # Using getattr to avoid linter issues
-        try:
-            current_app.logger.info("Attempting to create GenerativeModel with 'models/gemini-flash-latest'")
-            model = genai.GenerativeModel("models/gemini-flash-latest")  # Using the latest flash model
-            current_app.logger.info("Model created successfully, sending prompt")
-            response = model.generate_content(prompt)
-            raw_text = response.text.strip()
-            current_app.logger.info("Response received successfully")
-        except Exception as model_error:
-            current_app.logger.error(f"AI model error with models/gemini-flash-latest: {model_error}")
-            # Try a fallback model
-            try:
-                current_app.logger.info("Attempting fallback with 'models/gemini-pro-latest'")
-                model = genai.GenerativeModel("models/gemini-pro-latest")  # Fallback to latest pro model
-                response = model.generate_content(prompt)
-                raw_text = response.text.strip()
-                current_app.logger.info("Fallback response received successfully")
-            except Exception as fallback_error:
-                current_app.logger.error(f"AI model error with fallback models/gemini-pro-latest: {fallback_error}")
-                # Try another fallback model
-                try:
-                    current_app.logger.info("Attempting fallback with 'models/gemini-2.0-flash'")
-                    model = genai.GenerativeModel("models/gemini-2.0-flash")  # Another fallback option
-                    response = model.generate_content(prompt)
-                    raw_text = response.text.strip()
-                    current_app.logger.info("Second fallback response received successfully")
-                except Exception as second_fallback_error:
-                    current_app.logger.error(f"AI model error with second fallback models/gemini-2.0-flash: {second_fallback_error}")
-                    raise second_fallback_error
+        current_app.logger.debug("Sending prompt to AI: %s", prompt)
         
+        # Identical requests produce identical prompts, so reuse the last good response
+        use_cache = current_app.config["LLM_CACHE"]
+        cache_key = _ai_cache_key(board, class_, subject, qdist, ddist, paper_language, topic, chapters)
+        raw_text = cache.get(cache_key) if use_cache else None
+        from_cache = raw_text is not None
+        if from_cache:
+            current_app.logger.info(f"AI response served from cache (key {cache_key[:12]})")
+        else:
+            raw_text = _generate_ai_text(prompt)
+
         # Log the AI response
-        current_app.logger.info(f"AI response: {raw_text}")
+        current_app.logger.debug("AI response: %s", raw_text)
 
-        try:
-            questions = json.loads(raw_text)
-        except json.JSONDecodeError:
-            json_match = re.search(r"```json\s*(.*?)```", raw_text, re.DOTALL)
-            if json_match:
-                questions = json.loads(json_match.group(1))
-            else:
-                raise ValueError("AI returned invalid JSON.")
+        questions = _parse_ai_questions(raw_text)
+
+        if use_cache and not from_cache:
+            # Only cache responses that parsed, so a bad generation isn't replayed for a day
+            cache.set(cache_key, raw_text, timeout=AI_CACHE_TIMEOUT)
 
         for q in questions:
             q["question_type"] = _normalize_qtype(q.get("type"))
@@ -417,32 +646,59 @@ Begin generating the question paper now:
 
         # This block now correctly saves questions with a chapter_id
         processed_questions = []
+        fingerprints = []
         for q in questions: # Note: 'questions' here is the list from the AI
             q_type = _normalize_qtype(q.get("type"))
-            q_text = q.get("question", "")
-            
-            # Only save to DB if we found a chapter to link it to
-            if first_chapter_id:
-                new_q = Question(
-                    chapter_id=first_chapter_id,
-                    question_type=q_type,
-                    difficulty=q.get("difficulty"),
-                    marks=q.get("marks"),
-                    question_text=q_text,
-                    options=q.get("options") if q_type == "MCQ" else None,
-                    answer=q.get("answer", "Not provided"),
-                    source="AI",
-                    explanation=q.get("explanation", ""),
-                    language=paper_language
-                )
-                db.session.add(new_q)
-                db.session.flush() # Use flush to get the ID before committing
-                q['id'] = new_q.id # Add the new database ID to the question object
-
             q['source'] = "AI"
             q['question_type'] = q_type
-            q['question_text'] = q_text
+            q['question_text'] = q.get("question", "")
+            fingerprint = _question_fingerprint(q['question_text'])
+            if fingerprint in fingerprints:
+                # Same question again, only spaced or cased differently: keep the first
+                continue
+            q['options'] = _normalize_options(q.get("options")) if q_type == "MCQ" else None
             processed_questions.append(q)
+            fingerprints.append(fingerprint)
+
+        # Only save to DB if we found a chapter to link it to
+        if first_chapter_id and processed_questions:
+            # Questions this chapter already has (say from an earlier paper) are reused, not re-inserted
+            known_ids = dict(db.session.execute(
+                select(Question.fingerprint, Question.id).where(
+                    Question.chapter_id == first_chapter_id,
+                    Question.fingerprint.in_(fingerprints),
+                )
+            ).all())
+            new_rows = {}
+            for q, fingerprint in zip(processed_questions, fingerprints):
+                if fingerprint in known_ids:
+                    continue
+                new_rows[fingerprint] = {
+                    "chapter_id": first_chapter_id,
+                    "question_type": q['question_type'],
+                    "difficulty": q.get("difficulty"),
+                    "marks": int(q.get("marks") or 0),
+                    "question_text": q['question_text'],
+                    "options": q['options'],
+                    "answer": q.get("answer", "Not provided"),
+                    "source": "AI",
+                    "explanation": q.get("explanation", ""),
+                    "language": paper_language,
+                    "fingerprint": fingerprint,
+                }
+            if new_rows:
+                # One executemany INSERT instead of add()+flush() per question. Asking for the
+                # new ids back would turn it into one INSERT per row on MySQL (no RETURNING),
+                # so they're read back by (chapter, fingerprint) through ix_q_chap_fingerprint.
+                db.session.execute(insert(Question), list(new_rows.values()))
+                known_ids.update(db.session.execute(
+                    select(Question.fingerprint, Question.id).where(
+                        Question.chapter_id == first_chapter_id,
+                        Question.fingerprint.in_(list(new_rows)),
+                    )
+                ).all())
+            for q, fingerprint in zip(processed_questions, fingerprints):
+                q['id'] = known_ids[fingerprint] # Add the database ID to the question object
 
         questions = processed_questions
         db.session.commit()
@@ -458,31 +714,33 @@ Begin generating the question paper now:
     existing_question_texts = {q.get("question_text", "").strip().lower() for q in questions}
     
     if len(questions) < total_needed:
+        # NEW: Convert chapter names from the form into a list of chapter IDs for the query
+        chapter_id_list = []
+        if chapters:
+            chapter_id_list = [
+                row[0] for row in
+                db.session.query(Chapter.chapter_id).filter(Chapter.title_en.in_(chapters))
+            ]
+
+        # Per-type counts in one pass over the questions, not one pass per type
+        picked_by_type = Counter(q.get("question_type") for q in questions)
+
+        # (type, marks) -> how many more questions of it the paper needs
+        missing = {}
         for qtype_frontend, info in qdist.items():
-            count_needed = int(info['count'])
-            marks = int(info['marks'])
-            
             # --- FIX #4: USE NORMALIZED TYPE FOR COUNTING AND QUERYING ---
             normalized_type = _normalize_qtype(qtype_frontend)
-            
-            # Count how many questions of this type we already have
-            picked_count = sum(1 for q in questions if q.get("question_type") == normalized_type)
-            missing_for_type = max(0, count_needed - picked_count)
-
+            missing_for_type = max(0, int(info['count']) - picked_by_type[normalized_type])
             if missing_for_type > 0:
-                # Create the base query with exact criteria ONLY
-                query = Question.query.filter_by(
-                    question_type=normalized_type, 
-                    marks=marks, 
-                    language=paper_language
-                )
-                
+                key = (normalized_type, int(info['marks']))
+                missing[key] = missing.get(key, 0) + missing_for_type
 
-            # NEW: Convert chapter names from the form into a list of chapter IDs for the query
-            chapter_id_list = []
-            if chapters:
-                chapter_objects = Chapter.query.filter(Chapter.title_en.in_(chapters)).all()
-                chapter_id_list = [c.chapter_id for c in chapter_objects]
+        if missing:
+            # One query for every type that is short, with the exact criteria ONLY
+            query = Question.query.filter(
+                Question.language == paper_language,
+                tuple_(Question.question_type, Question.marks).in_(list(missing)),
+            )
 
             # NEW: Correctly filter using JOINs or chapter IDs
             if chapter_id_list:
@@ -498,21 +756,31 @@ Begin generating the question paper now:
                     query = query.filter(Subject.name_en == subject)
                 if class_:
                     query = query.join(Class).filter(Class.class_number == class_)
-                
-                # Get more questions than needed to filter duplicates
-                db_questions = (
-                    query
-                    .order_by(func.rand())
-                    .limit(missing_for_type * 2)  # Get extra questions to filter duplicates
-                    .all()
-                )
-                
+
+            # Sample ids instead of ORDER BY RAND(): only the narrow id columns are read,
+            # and just the picked rows are loaded in full (extra ones cover duplicates)
+            candidate_ids = {}
+            for qid, qtype, qmarks in query.with_entities(Question.id, Question.question_type, Question.marks):
+                candidate_ids.setdefault((qtype, qmarks), []).append(qid)
+            sampled_ids = []
+            for key, ids in candidate_ids.items():
+                sampled_ids.extend(random.sample(ids, min(len(ids), missing[key] * 2)))
+
+            db_questions = {}
+            if sampled_ids:
+                for q in Question.query.options(*_QUESTION_AS_DICT_OPTIONS).filter(Question.id.in_(sampled_ids)):
+                    db_questions.setdefault((q.question_type, q.marks), []).append(q)
+
+            for key, missing_for_type in missing.items():
+                candidates = db_questions.get(key, [])
+                random.shuffle(candidates)
+
                 # Add questions while avoiding duplicates
                 added_count = 0
-                for q in db_questions:
+                for q in candidates:
                     if added_count >= missing_for_type:
                         break
-                        
+
                     question_text = q.question_text.strip().lower()
                     if question_text not in existing_question_texts:
                         q_dict = q.as_dict()
@@ -522,10 +790,10 @@ Begin generating the question paper now:
                         questions.append(q_dict)
                         existing_question_texts.add(question_text)
                         added_count += 1
-                        
+
                 # Log how many questions we were able to add
-                current_app.logger.info(f"Added {added_count} questions of type {normalized_type} from database. Total questions now: {len(questions)}")
-        
+                current_app.logger.info(f"Added {added_count} questions of type {key[0]} from database. Total questions now: {len(questions)}")
+
         # Final fallback - if we still don't have enough questions, generate some basic ones
         if len(questions) < total_needed:
             current_app.logger.info(f"Still need {total_needed - len(questions)} questions, generating basic fallback questions")
@@ -537,6 +805,7 @@ Begin generating the question paper now:
                     "type": "Short",
                     "question_type": "Short Answer",
                     "question": f"Explain the basic concepts related to {subject} for Class {class_}.",
+                    "question_text": f"Explain the basic concepts related to {subject} for Class {class_}.",
                     "marks": 3,
                     "difficulty": "Medium",
                     "answer": "Answer would depend on the specific topic.",
@@ -548,346 +817,340 @@ Begin generating the question paper now:
                 questions.append(basic_question)
                 
             current_app.logger.info(f"Generated {missing_count} fallback questions. Total questions now: {len(questions)}")
-    paper_id = str(uuid.uuid4())[:8]
-    pdf_filename = f"paper_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
     word_filename = f"{paper_id}.docx"
     answer_key_filename = f"answer_key_{paper_id}.pdf"
 
-    paper_entry = Paper()
-    paper_entry.paper_id = paper_id
+    papers_dir = current_app.config["PAPERS_DIR"]
+
+    # Bucket the questions by PDF section instead of sorting them: the paper is the
+    # sections in _SECTION_ORDER, then anything whose type has no section
+    sections = {sec_type: [] for sec_type in _SECTION_ORDER}
+    unsectioned = []
+    for q in questions:
+        sec_type = _SECTION_FOR_TYPE.get((q.get("question_type") or q.get("type") or "").strip())
+        (sections[sec_type] if sec_type else unsectioned).append(q)
+        # Math markup is rendered once here and shared by the PDF template and the answer key
+        q["question_html"] = render_simple_math(q.get("question_text"))
+        if q.get("options"):
+            q["options_html"] = [render_simple_math(opt) for opt in q["options"]]
+    questions_sorted = [q for sec_type in _SECTION_ORDER for q in sections[sec_type]]
+    questions_sorted.extend(unsectioned)
+
+    # One pass for the totals and the PaperQuestion rows (in paper order, so the
+    # row ids give the question numbering back when the paper is loaded)
+    total_questions = 0
+    total_marks = 0
+    paper_question_rows = []
+    for q in questions_sorted:
+        total_questions += 1
+        q["number"] = total_questions  # printed as Q<n>; sections come first, so this matches the PDF
+        total_marks += int(q.get("marks") or 0)
+        paper_question_rows.append({
+            "paper_id": paper_id,
+            "question_id": q.get('id'),
+            "question_text": q.get("question_text"),
+            "type": q.get("question_type"),
+            "difficulty": q.get("difficulty"),
+            "marks": q.get("marks"),
+            "options": q.get("options") if q.get("options") else None,
+            "answer": q.get("answer", "Not provided"),
+            "explanation": q.get("explanation", ""),
+            "source": q.get("source", "Database"),
+        })
+
+    summary = {
+        "total_questions": total_questions,
+        "total_marks": total_marks
+    }
+
+    paper_payload = {
+        "paper_id": paper_id, "examName": exam_name, "schoolName": school,
+        "schoolBoard": board, "class": class_, "subject": subject,
+        "questions": questions_sorted, "summary": summary
+    }
+
+    # Fill in the pending row as soon as the questions are settled; the status route can
+    # show them while the PDF/DOCX are still rendering (pdf_ready flips once they're written)
+    paper_entry = db.session.execute(select(Paper).where(Paper.paper_id == paper_id)).scalar_one()
+    paper_entry.status = "done"
     paper_entry.exam_name = exam_name
     paper_entry.school_name = school
     paper_entry.board = board
     paper_entry.class_ = class_
     paper_entry.subject = subject
-    paper_entry.total_questions = len(questions)
-    paper_entry.total_marks = sum(int(q.get("marks", 0)) for q in questions)
-    paper_entry.pdf_path = f"/static/papers/{pdf_filename}"
+    paper_entry.total_questions = total_questions
+    paper_entry.total_marks = total_marks
+    paper_entry.pdf_ready = False
     paper_entry.word_path = f"/static/papers/{word_filename}"
     paper_entry.answer_key_path = f"/static/papers/{answer_key_filename}"
-    paper_entry.visitor_id = visitor.visitor_id  # Link paper to visitor
-    
-    db.session.add(paper_entry)
-    db.session.commit()
 
-    for q in questions:
-        pq = PaperQuestion()
-        pq.paper_id = paper_id
-        pq.question_id = q.get('id')
-        pq.question_text = q.get("question_text")
-        pq.type = q.get("question_type")
-        pq.difficulty = q.get("difficulty")
-        pq.marks = q.get("marks")
-        pq.options = q.get("options") if q.get("options") else None
-        pq.answer = q.get("answer", "Not provided")
-        db.session.add(pq)
+    if paper_question_rows:
+        # ORM bulk INSERT: batched into multi-row INSERT ... VALUES statements
+        db.session.execute(insert(PaperQuestion), paper_question_rows)
     db.session.commit()
 
-    papers_dir = os.path.join(current_app.root_path, "static", "papers")
-    os.makedirs(papers_dir, exist_ok=True)
-    json_path = os.path.join(papers_dir, f"{paper_id}.json")
-
-    summary = {
-        "total_questions": len(questions),
-        "total_marks": sum(int(q.get("marks", 0)) for q in questions)
-    }
-
-    type_order = ["MCQ", "Multiple Choice", "Fill in the Blanks", "Fill", "Short Answer", "Short", "Long Answer", "Long", "Matching", "Match", "Match the Following", "Case Study", "Case"]
-    def get_type_order(q):
-        t = (q.get("type") or q.get("question_type") or "").strip()
-        try: return type_order.index(t)
-        except ValueError: return len(type_order)
-    questions_sorted = sorted(questions, key=get_type_order)
-
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump({
-            "paper_id": paper_id, "examName": exam_name, "schoolName": school,
-            "schoolBoard": board, "class": class_, "subject": subject,
-            "questions": questions_sorted, "summary": summary
-        }, f, indent=2, ensure_ascii=False)
-
-
     # --- PDF GENERATION WITH WEASYPRINT (FINAL VERSION) ---
     
-    # Get the absolute path to the local font file
-    font_path = os.path.join(current_app.root_path, 'fonts', 'NotoSansDevanagari-Regular.ttf')
-    font_url = pathlib.Path(font_path).as_uri() # Converts path to file:/// URI
-
-    sections = {
-        "Multiple Choice": [], "Fill in the Blanks": [], "Short Answer": [],
-        "Long Answer": [], "Matching": [], "Case Study": []
-    }
-    section_titles = {
-        "Multiple Choice": "Section A - Multiple Choice Questions",
-        "Fill in the Blanks": "Section B - Fill in the Blanks",
-        "Short Answer": "Section C - Short Answer Questions",
-        "Long Answer": "Section D - Long Answer Questions",
-        "Matching": "Section E - Matching Questions",
-        "Case Study": "Section F - Case Study"
-    }
-    for q in questions_sorted:
-        q_type = _normalize_qtype(q.get("question_type", ""))
-        if q_type == "MCQ": q_type = "Multiple Choice"
-        if q_type in sections:
-            sections[q_type].append(q)
-
-    # Define the HTML template for the PDF
-    # ...existing code...
-
-    html_template = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <style>
-            @page {
-                size: A4;
-                margin: 25mm 20mm 25mm 20mm;
-            }
-            @font-face {
-                font-family: 'Noto Sans Devanagari';
-                src: url('{{ font_url }}');
-            }
-            html, body {
-                font-family: 'Noto Sans Devanagari', sans-serif;
-                font-size: 12pt;
-                background: #fff;
-            }
-            .paper-container {
-                width: 100%;
-                margin: 0;
-                padding: 0;
-            }
-            .paper-header {
-                text-align: center;
-                margin-bottom: 18px;
-                border-bottom: 2px solid #222;
-                padding-bottom: 8px;
-            }
-            .paper-header h1 { font-size: 22pt; margin: 0; }
-            .paper-header h2 { font-size: 16pt; margin: 4px 0; font-weight: normal; }
-            .paper-header h3 { font-size: 13pt; margin: 4px 0; font-weight: normal; }
-            .details {
-                display: flex;
-                justify-content: space-between;
-                margin-bottom: 18px;
-                font-size: 11pt;
-            }
-            section {
-                margin-bottom: 22px;
-            }
-            h4.section-title {
-                font-size: 13pt;
-                border-bottom: 1px solid #bbb;
-                padding: 4px 0;
-                margin-bottom: 12px;
-                margin-top: 0;
-            }
-            ol.question-list {
-                list-style-type: none;
-                padding-left: 0;
-                margin-top: 0;
-            }
-            li.question {
-                margin-bottom: 16px;
-            }
-            .question-text {
-                display: flex;
-                justify-content: space-between;
-            }
-            .question-text .marks {
-                font-weight: bold;
-                white-space: nowrap;
-                padding-left: 12px;
-            }
-            ol.options {
-                list-style-type: lower-alpha;
-                padding-left: 32px;
-                margin-top: 7px;
-                margin-bottom: 0;
-            }
-            .option {
-                margin-bottom: 4px;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="paper-container">
-            <div class="paper-header">
-                <h1>{{ school }}</h1>
-                <h2>{{ exam_name }}</h2>
-                <h3>Class {{ class_ }} - {{ subject }}</h3>
-            </div>
-            <div class="details">
-                <span>Date: {{ date }}</span>
-            </div>
-
-            {% set q_num = namespace(value=1) %}
-            {% for sec_type, q_list in sections.items() %}
-                {% if q_list %}
-                <section>
-                    <h4 class="section-title">{{ section_titles[sec_type] }}</h4>
-                    <ol class="question-list">
-                        {% for q in q_list %}
-                        <li class="question">
-                            <div class="question-text">
-                                <span><b>Q{{ q_num.value }}.</b> {{ q.question_text | math_render | safe }}</span>
-                                <span class="marks">({{ q.marks }} marks)</span>
-                            </div>
-                            {% if q.question_type == 'MCQ' and q.options %}
-                            <ol class="options">
-                                {% for opt in q.options %}
-                                <li class="option">{{ opt | math_render | safe }}</li>
-                                {% endfor %}
-                            </ol>
-                            {% endif %}
-                        </li>
-                        {% set q_num.value = q_num.value + 1 %}
-                        {% endfor %}
-                    </ol>
-                </section>
-                {% endif %}
-            {% endfor %}
-        </div>
-    </body>
-    </html>
-    """
-
-
-    
-    def to_char_filter(n):
-        return chr(97 + n)  # Convert to lowercase letters (a, b, c, d)
-    
-    env = current_app.jinja_env
-    env.filters['to_char'] = to_char_filter
-    env.filters['math_render'] = render_simple_math
-    
-    rendered_html = render_template_string(
-        html_template, 
-        font_url=font_url, # Pass the local font path to the template
+    # templates/paper_pdf.html is compiled once and then reused from Jinja's template cache
+    rendered_html = render_template(
+        "paper_pdf.html",
         school=school,
         exam_name=exam_name or f"{board} Board Examination",
         class_=class_,
         subject=subject,
         date=datetime.now().strftime('%d-%m-%Y'),
         sections=sections,
-        section_titles=section_titles
+        section_titles=_SECTION_TITLES
     )
     
+    # Name the PDF after its content: an identical paper is already on disk and
+    # WeasyPrint (the slowest step here) can be skipped entirely
+    pdf_digest = hashlib.sha256(pdf_render.PAPER_CSS_DIGEST + rendered_html.encode("utf-8")).hexdigest()[:16]
+    pdf_filename = f"paper_{pdf_digest}.pdf"
     pdf_path = os.path.join(papers_dir, pdf_filename)
-    HTML(string=rendered_html).write_pdf(pdf_path)
+    word_path = os.path.join(papers_dir, word_filename)
+
+    # Paper + PaperQuestion already hold the paper, so there is no JSON sidecar to
+    # write; the .docx is built here while worker processes render the two PDFs
+    pdf_futures = []
+    if os.path.exists(pdf_path):
+        current_app.logger.info(f"Reusing rendered PDF {pdf_filename}")
+    else:
+        pdf_futures.append(_pdf_processes.submit(pdf_render.build_pdf, pdf_path, rendered_html))
+    answer_key_path = os.path.join(papers_dir, answer_key_filename)
+    pdf_futures.append(_pdf_processes.submit(pdf_render.build_pdf, answer_key_path, _render_answer_key(paper_payload)))
+    _write_artifact(_build_docx, word_path, paper_payload)
+    if current_app.config["DEBUG_WRITE_JSON"]:
+        _write_json(os.path.join(papers_dir, f"{paper_id}.json"), paper_payload)
+    for future in pdf_futures:
+        future.result()
+
+    # Every artifact is on disk now: record the PDF and let clients download it
+    paper_entry.pdf_path = f"/static/papers/{pdf_filename}"
+    paper_entry.pdf_ready = True
+    db.session.commit()
 
 
-    return jsonify({
-        "questions": [{
-            "id": q.get("id"), "question_text": q.get("question_text"),
-            "marks": q.get("marks"), "difficulty": q.get("difficulty"),
-            "type": q.get("type") or q.get("question_type"), "source": q.get("source", "Database")
-        } for q in questions_sorted],
-        "summary": summary,
-        "pdf_url": f"/static/papers/{pdf_filename}",
-        "word_url": f"/api/download/word/{paper_id}",
-        "answer_key_url": f"/api/download/answer_key/{paper_id}"
-    })
+def _write_artifact(build, path, paper):
+    # The status route offers the Word/answer-key links before these are written, so a
+    # download must see either no file (and build one on the fly) or the whole file
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    build(tmp_path, paper)
+    os.replace(tmp_path, path)
+
+
+def _write_json(path, payload):
+    # Compact UTF-8 bytes straight from orjson; only written for debugging/offline export
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(payload))
+
+
+def _read_json(path):
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+
+@lru_cache(maxsize=256)
+def _read_paper_json(path, mtime_ns):
+    # mtime is part of the key, so a rewritten sidecar is re-read automatically
+    return _read_json(path)
+
+
+def _load_paper(paper_id):
+    """Paper metadata plus its questions in order, or None if the paper doesn't exist"""
+    # Papers from before the questions were read back from the DB have a JSON sidecar. Their
+    # PaperQuestion rows lack the explanations and are in insertion order rather than the
+    # order printed in their PDF, so the sidecar wins (shared between calls: don't mutate it)
+    json_path = os.path.join(current_app.config["PAPERS_DIR"], f"{paper_id}.json")
+    try:
+        mtime_ns = os.stat(json_path).st_mtime_ns
+    except FileNotFoundError:
+        pass
+    else:
+        return _read_paper_json(json_path, mtime_ns)
+
+    paper_entry = db.session.execute(
+        select(Paper).where(Paper.paper_id == paper_id).options(selectinload(Paper.questions))
+    ).scalar_one_or_none()
+    if paper_entry is None:
+        return None
+    # Rows are created pending, before any questions exist
+    return paper_entry.as_dict() if paper_entry.status == "done" else None
+
+
+# WeasyPrint is pure Python and holds the GIL for the whole render, so PDFs are rendered
+# in worker processes: concurrent builds then use separate cores instead of taking turns.
+# "spawn" keeps the children clear of locks held by this process's threads at fork time.
+# A spawn child re-imports the parent's __main__ (as __mp_main__) and then only app.pdf_render,
+# so the entry script must not build the app or touch this pool at import time (see run.py).
+# Every web worker gets its own pool, so keep it small.
+_PDF_RENDER_PROCESSES = int(os.getenv("PDF_RENDER_PROCESSES", "2"))
+_pdf_processes = ProcessPoolExecutor(
+    max_workers=_PDF_RENDER_PROCESSES,
+    mp_context=multiprocessing.get_context("spawn"),
+    initializer=pdf_render.init_worker,
+)
+
+
+def warm_pdf_workers():
+    """Start the PDF workers now; a spawn pool only starts a process when a job arrives"""
+    # Nothing idle yet, so each submit starts one more worker (running pdf_render.init_worker)
+    for _ in range(_PDF_RENDER_PROCESSES):
+        _pdf_processes.submit(pdf_render.worker_ready)
+
+
+def _option_label(index):
+    """MCQ option label in the Word paper: a, b, ... z, then plain numbers"""
+    return chr(ord("a") + index) if index < 26 else str(index + 1)
+
+
+# Characters XML 1.0 can't carry at all; python-docx would reject them, here they're dropped
+_XML_INVALID_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+@lru_cache(maxsize=1)
+def _docx_skeleton():
+    """The parts of python-docx's default document, split around the body we write ourselves"""
+    buffer = io.BytesIO()
+    Document().save(buffer)
+    with zipfile.ZipFile(buffer) as zf:
+        parts = [(name, zf.read(name)) for name in zf.namelist()]
+    document_xml = dict(parts)["word/document.xml"].decode("utf-8")
+    body_open = document_xml.index("<w:body>") + len("<w:body>")
+    sect_pr = re.search(r"<w:sectPr\b.*</w:sectPr>", document_xml, re.DOTALL).group(0)
+    return parts, document_xml[:body_open], sect_pr + "</w:body></w:document>"
+
+
+def _docx_paragraph(text, style=None):
+    text = escape(_XML_INVALID_RE.sub("", str(text)))
+    # Like python-docx's add_paragraph: newlines become line breaks and tabs become tabs,
+    # which keeps multi-line Matching/Case Study/Assertion-Reason questions intact
+    lines = [
+        '<w:tab/>'.join(f'<w:t xml:space="preserve">{part}</w:t>' if part else "" for part in line.split("\t"))
+        for line in text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    ]
+    props = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ""
+    return f'<w:p>{props}<w:r>{"<w:br/>".join(lines)}</w:r></w:p>'
+
+
+def _build_docx(target, paper):
+    """Write the Word version of a paper to a path or file object"""
+    # The layout is fixed, so document.xml is assembled as a string and zipped next to the
+    # untouched parts of the default template instead of growing a python-docx lxml tree
+    parts, body_head, body_tail = _docx_skeleton()
+    paragraphs = [
+        _docx_paragraph(paper.get("examName", "Question Paper"), "Title"),
+        _docx_paragraph(f"School: {paper.get('schoolName')}"),
+        _docx_paragraph(f"Board: {paper.get('schoolBoard')}"),
+        _docx_paragraph(f"Class: {paper.get('class')}  Subject: {paper.get('subject')}"),
+        _docx_paragraph("Questions", "Heading1"),
+    ]
+    for i, q in enumerate(paper.get("questions", []), 1):
+        # Built during the paper build now, so a missing key would fail the whole paper
+        question_text = q.get("question_text") or q.get("question", "")
+        paragraphs.append(_docx_paragraph(f"Q{i}. {question_text} ({q.get('marks')} marks) [{q.get('difficulty')}]"))
+        if q.get("question_type") in ["MCQ", "Multiple Choice"]:
+            for index, opt in enumerate(q.get("options") or ()):
+                paragraphs.append(_docx_paragraph(f"   ({_option_label(index)}) {opt}", "ListBullet"))
+    document_xml = body_head + "".join(paragraphs) + body_tail
+    with zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        for name, data in parts:
+            zf.writestr(name, document_xml if name == "word/document.xml" else data)
+
+
+@main.route("/api/download/pdf/<paper_id>", methods=["GET"])
+def download_pdf(paper_id):
+    paper_entry = Paper.query.filter_by(paper_id=paper_id).first()
+    if paper_entry is None or paper_entry.status == "failed":
+        return jsonify({"error": "Paper not found"}), 404
+    if paper_entry.pdf_failed:
+        return jsonify({"error": "The PDF could not be rendered"}), 500
+    if not paper_entry.pdf_ready or not paper_entry.pdf_path:
+        return jsonify({"paper_id": paper_id, "status": "pending"}), 202
+    pdf_filename = os.path.basename(paper_entry.pdf_path)
+    pdf_path = os.path.join(current_app.config["PAPERS_DIR"], pdf_filename)
+    if not os.path.exists(pdf_path):
+        return jsonify({"error": "Paper not found"}), 404
+
+    accel_prefix = current_app.config.get("PDF_X_ACCEL_PREFIX")
+    if accel_prefix:
+        # Let nginx stream the file itself (sendfile) instead of copying it through Python
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = f"{accel_prefix.rstrip('/')}/{pdf_filename}"
+        response.headers["Content-Type"] = "application/pdf"
+        # nginx passes these through from this response; same name and caching as send_file below
+        response.headers.set("Content-Disposition", "inline", filename=f"paper_{paper_id}.pdf")
+        response.cache_control.public = True
+        response.cache_control.max_age = 86400
+        # A PDF never changes once written (new ones are named after their content hash)
+        response.set_etag(os.path.splitext(pdf_filename)[0])
+        return response
+
+    # PDFs are content-addressed and never change, so they can be cached hard
+    return send_file(
+        pdf_path,
+        mimetype="application/pdf",
+        download_name=f"paper_{paper_id}.pdf",
+        conditional=True,
+        etag=True,
+        max_age=86400
+    )
 
 
 @main.route("/api/download/word/<paper_id>", methods=["GET"])
 def download_word(paper_id):
-    json_path = os.path.join(current_app.root_path, "static", "papers", f"{paper_id}.json")
-    if not os.path.exists(json_path):
+    paper = _load_paper(paper_id)
+    if paper is None:
         return jsonify({"error": "Paper not found"}), 404
-    with open(json_path, "r", encoding="utf-8") as f:
-        paper = json.load(f)
-    doc = Document()
-    doc.add_heading(paper.get("examName", "Question Paper"), 0)
-    doc.add_paragraph(f"School: {paper.get('schoolName')}")
-    doc.add_paragraph(f"Board: {paper.get('schoolBoard')}")
-    doc.add_paragraph(f"Class: {paper.get('class')}  Subject: {paper.get('subject')}")
-    doc.add_heading("Questions", level=1)
-    for i, q in enumerate(paper.get("questions", []), 1):
-        doc.add_paragraph(f"Q{i}. {q['question_text']} ({q['marks']} marks) [{q['difficulty']}]")
-        if q.get("question_type") in ["MCQ", "Multiple Choice"]:
-            options = q.get("options", [])
-            for idx, opt in enumerate(options, start=1):
-                doc.add_paragraph(f"   ({chr(96+idx)}) {opt}", style="List Bullet")
-    buf = io.BytesIO()
-    doc.save(buf)
-    buf.seek(0)
+    docx_path = os.path.join(current_app.config["PAPERS_DIR"], f"{paper_id}.docx")
+    if not os.path.exists(docx_path):
+        # Papers generated before the .docx was written alongside the PDF: build it
+        # once and keep it, so later downloads are a plain file send
+        _write_artifact(_build_docx, docx_path, paper)
     return send_file(
-        buf,
+        docx_path,
+        conditional=True,
         as_attachment=True,
         download_name=f"paper_{paper_id}.docx",
         mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
     )
 
-@main.route("/api/download/answer_key/<paper_id>", methods=["GET"])
-def download_answer_key(paper_id):
-    json_path = os.path.join(current_app.root_path, "static", "papers", f"{paper_id}.json")
-    if not os.path.exists(json_path):
-        return jsonify({"error": "Paper not found"}), 404
 
-    with open(json_path, "r", encoding="utf-8") as f:
-        paper = json.load(f)
+def _render_answer_key(paper):
+    """The answer-key HTML for a paper; rendered with the paper stylesheet like the paper itself"""
+    questions = [
+        {
+            "number": i,
+            "question_html": q.get("question_html") or render_simple_math(q.get("question_text", "")),
+            "answer_html": render_simple_math(q.get("answer") or "Answer not available"),
+            "explanation_html": render_simple_math(q.get("explanation", "")),
+        }
+        for i, q in enumerate(paper.get("questions", []), 1)
+    ]
+    return render_template(
+        "answer_key_pdf.html",
+        exam_name=paper.get("examName", "Exam"),
+        school=paper.get("schoolName", ""),
+        class_=paper.get("class", ""),
+        subject=paper.get("subject", ""),
+        questions=questions,
+    )
 
-    # NOTE: This still uses reportlab. It may have issues with Hindi rendering.
-    pdfmetrics.registerFont(TTFont("NotoSans", os.path.join(current_app.root_path, "fonts", "NotoSansDevanagari-Regular.ttf")))
-    pdfmetrics.registerFont(TTFont("NotoSans-Bold", os.path.join(current_app.root_path, "fonts", "NotoSansDevanagari-Bold.ttf")))
 
-    buf = io.BytesIO()
-    c = canvas.Canvas(buf, pagesize=A4)
-    width, height = A4
-    
-    styles = getSampleStyleSheet()
-    styleN = styles["Normal"]
-    styleN.fontName = "NotoSans"
-    styleB = styles["h5"]
-    styleB.fontName = "NotoSans-Bold"
-    
-    c.setFont("NotoSans-Bold", 16)
-    c.drawCentredString(width/2, height - 50, f"Answer Key - {paper.get('examName', 'Exam')}")
-    c.setFont("NotoSans", 12)
-    c.drawString(50, height - 80, f"School: {paper.get('schoolName', '')}")
-    c.drawString(50, height - 100, f"Class: {paper.get('class', '')} | Subject: {paper.get('subject', '')}")
-    c.line(50, height - 110, width - 50, height - 110)
-
-    y = height - 140
-    for i, q in enumerate(paper.get("questions", []), 1):
-        question_text = render_simple_math(q.get("question_text", "")) 
-        answer_text = render_simple_math(q.get("answer", "Answer not available")) 
-        explanation_text = render_simple_math(q.get("explanation", "")) 
-
-        p_q = Paragraph(f"<b>Q{i}:</b> {question_text}", styleN)
-        w, h = p_q.wrap(width - 100, y)
-        if y - h < 50:
-            c.showPage()
-            y = height - 50
-        p_q.drawOn(c, 50, y - h)
-        y -= (h + 10)
-
-        p_a = Paragraph(f"<b>Answer:</b> {answer_text}", styleN)
-        w, h = p_a.wrap(width - 100, y)
-        if y - h < 50:
-            c.showPage()
-            y = height - 50
-        p_a.drawOn(c, 70, y - h)
-        y -= (h + 10)
-
-        if explanation_text:
-            p_exp = Paragraph(f"<b>Explanation:</b> {explanation_text}", styleN)
-            w, h = p_exp.wrap(width - 100, y)
-            if y - h < 50:
-                c.showPage()
-                y = height - 50
-            p_exp.drawOn(c, 70, y - h)
-            y -= (h + 20)
-        else:
-            y -= 10
-
-    c.save()
-    buf.seek(0)
+@main.route("/api/download/answer_key/<paper_id>", methods=["GET"])
+def download_answer_key(paper_id):
+    paper = _load_paper(paper_id)
+    if paper is None:
+        return jsonify({"error": "Paper not found"}), 404
 
+    key_path = os.path.join(current_app.config["PAPERS_DIR"], f"answer_key_{paper_id}.pdf")
+    if not os.path.exists(key_path):
+        # Papers generated before the answer key was written alongside the PDF: build
+        # it once and keep it, like the Word download
+        _pdf_processes.submit(pdf_render.build_pdf, key_path, _render_answer_key(paper)).result()
     return send_file(
-        buf,
+        key_path,
+        conditional=True,
         as_attachment=True,
         download_name=f"answer_key_{paper_id}.pdf",
         mimetype="application/pdf"
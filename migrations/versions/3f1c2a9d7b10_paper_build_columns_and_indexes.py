@@ -0,0 +1,84 @@
+"""Paper build columns and question bank indexes
+
+Brings a database created from the original schema (or Sample Data/questions.sql) up to
+the current models. db.create_all() only creates missing tables, so it never adds these.
+
+Every step checks what is already there first: a fresh database built by create_all()
+already has all of it, and `flask db upgrade` is then just a no-op that records the revision.
+
+Revision ID: 3f1c2a9d7b10
+Revises:
+Create Date: 2026-10-15 22:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# table -> [(index name, columns)]
+_INDEXES = {
+    # Academic FK chain, walked by every dropdown and chapter lookup
+    "classes": [("ix_classes_board_id", ["board_id"])],
+    "subjects": [("ix_subjects_class_id", ["class_id"])],
+    "chapters": [("ix_chapters_subject_id", ["subject_id"])],
+    "questions": [
+        # Question bank lookups by chapter, then type and difficulty
+        ("ix_q_chap_type_diff", ["chapter_id", "question_type", "difficulty"]),
+        # The paper fallback's id sample by type, marks, language and chapter
+        ("ix_q_lookup", ["question_type", "marks", "language", "chapter_id"]),
+        # Finding AI questions a chapter already has
+        ("ix_q_chap_fingerprint", ["chapter_id", "fingerprint"]),
+    ],
+}
+
+
+def _columns(table):
+    return {c["name"] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def _indexes(table):
+    return {i["name"] for i in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade():
+    paper_columns = _columns("papers")
+    if "status" not in paper_columns:
+        # Rows from before background builds are all finished papers
+        op.add_column("papers", sa.Column("status", sa.String(20), nullable=False, server_default="done"))
+    if "pdf_ready" not in paper_columns:
+        op.add_column("papers", sa.Column("pdf_ready", sa.Boolean(), nullable=False, server_default=sa.text("1")))
+
+    paper_question_columns = _columns("paper_questions")
+    if "explanation" not in paper_question_columns:
+        op.add_column("paper_questions", sa.Column("explanation", sa.Text()))
+    if "source" not in paper_question_columns:
+        op.add_column("paper_questions", sa.Column("source", sa.String(50)))
+
+    if "fingerprint" not in _columns("questions"):
+        op.add_column("questions", sa.Column("fingerprint", sa.String(16)))
+
+    for table, indexes in _INDEXES.items():
+        existing = _indexes(table)
+        for name, columns in indexes:
+            if name not in existing:
+                op.create_index(name, table, columns)
+
+
+def downgrade():
+    # The FK chain indexes stay: on a create_all() database MySQL needs them for the foreign keys
+    existing = _indexes("questions")
+    for name, _ in _INDEXES["questions"]:
+        if name in existing:
+            op.drop_index(name, table_name="questions")
+    op.drop_column("questions", "fingerprint")
+    op.drop_column("paper_questions", "source")
+    op.drop_column("paper_questions", "explanation")
+    op.drop_column("papers", "pdf_ready")
+    op.drop_column("papers", "status")
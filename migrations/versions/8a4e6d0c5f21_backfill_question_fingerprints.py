@@ -0,0 +1,66 @@
+"""Backfill question fingerprints
+
+Questions that were in the bank before fingerprints existed have none, so the AI path
+could never match them. Fills them in, in id order and in batches.
+
+Revision ID: 8a4e6d0c5f21
+Revises: 3f1c2a9d7b10
+Create Date: 2026-10-15 23:10:00.000000
+
+"""
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6d0c5f21'
+down_revision = '3f1c2a9d7b10'
+branch_labels = None
+depends_on = None
+
+
+_BATCH_SIZE = 1000
+
+_questions = sa.table(
+    "questions",
+    sa.column("id", sa.Integer),
+    sa.column("question_text", sa.Text),
+    sa.column("fingerprint", sa.String(16)),
+)
+
+
+def _question_fingerprint(text):
+    # Frozen copy of routes._question_fingerprint: the two must produce the same hash
+    normalized = " ".join((text or "").lower().split())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def upgrade():
+    bind = op.get_bind()
+    update = (
+        sa.update(_questions)
+        .where(_questions.c.id == sa.bindparam("row_id"))
+        .values(fingerprint=sa.bindparam("row_fingerprint"))
+    )
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(_questions.c.id, _questions.c.question_text)
+            .where(_questions.c.fingerprint.is_(None), _questions.c.id > last_id)
+            .order_by(_questions.c.id)
+            .limit(_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        bind.execute(update, [
+            {"row_id": row_id, "row_fingerprint": _question_fingerprint(text)}
+            for row_id, text in rows
+        ])
+        last_id = rows[-1][0]
+
+
+def downgrade():
+    # Fingerprints are derived data; the column itself goes with the previous revision
+    pass
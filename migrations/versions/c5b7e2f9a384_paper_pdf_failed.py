@@ -0,0 +1,26 @@
+"""Paper.pdf_failed
+
+Revision ID: c5b7e2f9a384
+Revises: 8a4e6d0c5f21
+Create Date: 2026-10-16 10:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5b7e2f9a384'
+down_revision = '8a4e6d0c5f21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Skipped on a database create_all() already built with the column
+    if "pdf_failed" not in {c["name"] for c in sa.inspect(op.get_bind()).get_columns("papers")}:
+        op.add_column("papers", sa.Column("pdf_failed", sa.Boolean(), nullable=False, server_default=sa.text("0")))
+
+
+def downgrade():
+    op.drop_column("papers", "pdf_failed")
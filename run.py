@@ -1,6 +1,7 @@
 from app import create_app
 
-app = create_app()
-
+# Only build the app when run directly: the PDF worker processes are spawned, and each
+# one re-imports this script as __mp_main__. `flask --app run` finds create_app() itself.
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    app = create_app()
+    app.run(debug=True)